@@ -1,12 +1,26 @@
 import os
+import re
+import asyncio
 import logging
+import socket
+import time
+import hashlib
+from contextlib import aclosing
+from collections import defaultdict
+from functools import lru_cache
+from collections.abc import AsyncIterator, Iterator
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 from dotenv import load_dotenv
-import requests
+import httpx
+import orjson
+import redis.asyncio as redis
+from cachetools import TTLCache
 from google.adk.agents import Agent
+from google.adk.agents.invocation_context import new_invocation_context_id
+from google.adk.agents.run_config import RunConfig, StreamingMode
+from google.adk.events import Event
 from google.adk.runners import InMemoryRunner
-from google.adk.sessions import InMemorySessionService
 from google.adk.tools import google_search
 from google.genai import types
 
@@ -15,14 +29,61 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
 PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")
+TRIGGER_WORD = "knightbot"
+TRIGGER_PATTERN = re.compile(re.escape(TRIGGER_WORD), re.IGNORECASE)
+TRIGGER_PATTERN_BYTES = re.compile(re.escape(TRIGGER_WORD.encode()), re.IGNORECASE)
+REDIS_URL = os.getenv("REDIS_URL")
+# ADK sessions live in process memory, so more than one worker splits each
+# user's conversation across separate session stores.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
 
 WHATSAPP_API_URL = f"https://graph.facebook.com/v18.0/{PHONE_NUMBER_ID}/messages"
+WHATSAPP_HEADERS = {
+    "Authorization": f"Bearer {WHATSAPP_TOKEN}",
+    "Content-Type": "application/json"
+}
+
+QUEUE_MAXSIZE = 1000
+NUM_WORKERS = 8
+
+STREAM_KEY = "wa:incoming"
+STREAM_GROUP = "wa_workers"
+STREAM_MAXLEN = 100_000
+STREAM_CLAIM_IDLE_MS = 300_000
+# How often entries this process still holds are re-claimed, which resets
+# their idle time so no other consumer treats them as abandoned.
+STREAM_HEARTBEAT_SECONDS = STREAM_CLAIM_IDLE_MS / 1000 / 5
+
+RATE_LIMIT = 10
+RATE_LIMIT_WINDOW = 60
+
+# Each sender is routed to one worker queue so their messages are handled one
+# at a time and in the order they arrived.
+# (from_number, text, stream entry id or None)
+WorkItem = tuple[str, str, str | None]
+
+worker_queues: list[asyncio.Queue[WorkItem]] = []
+worker_tasks: list[asyncio.Task[None]] = []
+# Stream entries handed to a worker but not yet acked.
+in_flight: set[str] = set()
+
+# When REDIS_URL is set, incoming messages go through a Redis stream so they
+# survive restarts and can be picked up by a replacement process.
+redis_client = redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+
+# Messages per user in the current fixed window, keyed by (user, window).
+rate_counts: TTLCache[tuple[str, int], int] = TTLCache(maxsize=100_000, ttl=RATE_LIMIT_WINDOW)
+
+http_client = httpx.AsyncClient(
+    timeout=10.0,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+)
 
 os.environ["GOOGLE_API_KEY"] = GOOGLE_API_KEY
 os.environ["GOOGLE_GENAI_USE_VERTEXAI"] = "FALSE"
@@ -38,48 +99,238 @@ root_agent = Agent(
 )
 
 runner = InMemoryRunner(agent=root_agent, app_name=APP_NAME)
+run_config = RunConfig(streaming_mode=StreamingMode.SSE)
 session_service = runner.session_service
-sessions = {}
 
 
-async def get_or_create_session(user_id: str) -> str:
-    if user_id not in sessions:
-        session = await session_service.create_session(
+# Keeps fire-and-forget tasks referenced until they finish.
+background_tasks: set[asyncio.Task[None]] = set()
+
+
+def discard_session(user_id: str, session_id: str) -> None:
+    task = asyncio.get_running_loop().create_task(
+        session_service.delete_session(
             app_name=APP_NAME,
-            user_id=user_id
+            user_id=user_id,
+            session_id=session_id
         )
-        sessions[user_id] = session.id
-    return sessions[user_id]
-
+    )
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+class SessionCache(TTLCache[str, str]):
+    # InMemorySessionService keeps a session's events until it is deleted, so
+    # an entry dropped from this cache must take its ADK session with it.
+
+    def popitem(self) -> tuple[str, str]:
+        user_id, session_id = super().popitem()
+        discard_session(user_id, session_id)
+        return user_id, session_id
+
+    def expire(self, time: float | None = None) -> list[tuple[str, str]]:
+        expired = super().expire(time)
+        for user_id, session_id in expired:
+            discard_session(user_id, session_id)
+        return expired
+
+
+sessions = SessionCache(maxsize=10_000, ttl=3600)
+session_locks: dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+REPLY_CACHE_TTL = 3600
+reply_cache: TTLCache[str, str] = TTLCache(maxsize=2048, ttl=REPLY_CACHE_TTL)
+
+# Replies are sent in pieces of at least REPLY_CHUNK_SIZE characters, cut at
+# the first line break or sentence end past it. A piece with no boundary is
+# cut at REPLY_CHUNK_MAX, well under WhatsApp's 4096-character body limit.
+REPLY_CHUNK_SIZE = 300
+REPLY_CHUNK_MAX = 1500
+# A full stop after a digit ("4. ", list markers) or in a common abbreviation
+# ("e.g. ") does not end a sentence.
+REPLY_BOUNDARY = re.compile(
+    r"\n+|(?<![0-9])(?<!\be\.g)(?<!\bi\.e)(?<!\bvs)(?<!\bMr)(?<!\bMrs)(?<!\bMs)(?<!\bDr)(?<!\bSt)\.\s+|[?!]\s+"
+)
 
-async def run_agent(message: str, user_id: str) -> str:
+# Replies to these would go stale, so they always reach the agent.
+TIME_SENSITIVE = re.compile(r"\b(today|tonight|now|latest|current|yesterday|tomorrow)\b", re.IGNORECASE)
+
+
+async def get_or_create_session(user_id: str) -> tuple[str, bool]:
+    session_id = sessions.get(user_id)
+    if session_id is not None:
+        # Re-setting restarts the TTL, so the session expires an hour after
+        # the user's last message rather than their first.
+        sessions[user_id] = session_id
+        return session_id, False
+
+    # Two messages from the same user can arrive together; only one of them
+    # may create the ADK session.
+    created = False
+    async with session_locks[user_id]:
+        session_id = sessions.get(user_id)
+        if session_id is None:
+            session = await session_service.create_session(
+                app_name=APP_NAME,
+                user_id=user_id
+            )
+            session_id = session.id
+            sessions[user_id] = session_id
+            created = True
+
+    # Later calls take the fast path above, so the lock is no longer needed.
+    session_locks.pop(user_id, None)
+    return session_id, created
+
+
+def reply_cache_key(message: str) -> str | None:
+    if TIME_SENSITIVE.search(message):
+        return None
+    normalized = " ".join(message.lower().split())
+    return hashlib.blake2b(normalized.encode(), digest_size=16).hexdigest()
+
+
+async def get_cached_reply(key: str) -> str | None:
+    reply = reply_cache.get(key)
+    if reply is None and redis_client is not None:
+        # Not copied into reply_cache: a local copy would restart the TTL and
+        # outlive the Redis entry it came from.
+        reply = await redis_client.get(f"reply:{key}")
+    return reply
+
+
+async def set_cached_reply(key: str, reply: str) -> None:
+    reply_cache[key] = reply
+    if redis_client is not None:
+        await redis_client.setex(f"reply:{key}", REPLY_CACHE_TTL, reply)
+
+
+async def record_exchange(user_id: str, session_id: str, message: str, reply: str) -> None:
+    # A cache hit skips the runner, so write the turn into the session
+    # ourselves; otherwise the user's next message would lose this context.
+    session = await session_service.get_session(
+        app_name=APP_NAME,
+        user_id=user_id,
+        session_id=session_id
+    )
+    invocation_id = new_invocation_context_id()
+    await session_service.append_event(session, Event(
+        invocation_id=invocation_id,
+        author="user",
+        content=make_user_content(message)
+    ))
+    await session_service.append_event(session, Event(
+        invocation_id=invocation_id,
+        author=root_agent.name,
+        content=types.Content(role="model", parts=[types.Part(text=reply)])
+    ))
+
+
+@lru_cache(maxsize=512)
+def make_user_content(text: str) -> types.Content:
+    # The runner only reads the message, so repeated prompts can share one
+    # instance; model_construct skips pydantic validation of known-good fields.
+    return types.Content.model_construct(
+        role="user",
+        parts=[types.Part.model_construct(text=text)]
+    )
+
+
+def event_text(event: Event) -> str:
+    if event.content and event.content.parts:
+        return event.content.parts[0].text or ""
+    return ""
+
+
+def take_chunk(text: str) -> str:
+    match = REPLY_BOUNDARY.search(text, REPLY_CHUNK_SIZE)
+    if match and match.end() <= REPLY_CHUNK_MAX:
+        return text[:match.end()]
+    if len(text) < REPLY_CHUNK_MAX:
+        return ""
+    cut = text.rfind(" ", REPLY_CHUNK_SIZE, REPLY_CHUNK_MAX)
+    return text[:cut + 1] if cut != -1 else text[:REPLY_CHUNK_MAX]
+
+
+def iter_chunks(text: str) -> Iterator[str]:
+    while chunk := take_chunk(text):
+        yield chunk
+        text = text[len(chunk):]
+    if text:
+        yield text
+
+
+async def run_agent(message: str, user_id: str) -> AsyncIterator[str]:
     try:
-        session_id = await get_or_create_session(user_id)
-        user_message = types.Content(role="user", parts=[types.Part(text=message)])
-        
-        # Important fix: use await instead of async streaming
-        result = await runner.run_message(
+        session_id, first_turn = await get_or_create_session(user_id)
+
+        # Only the first message of a session is answered from the cache: its
+        # reply depends on nothing but the text, so it is safe to share
+        # between users. Later replies depend on the conversation so far.
+        cache_key = reply_cache_key(message) if first_turn else None
+        if cache_key is not None:
+            cached = await get_cached_reply(cache_key)
+            if cached is not None:
+                await record_exchange(user_id, session_id, message, cached)
+                for chunk in iter_chunks(cached):
+                    yield chunk
+                return
+
+        user_message = make_user_content(message)
+
+        # Text of the model turn being streamed, and how much of it has
+        # already been yielded.
+        turn_text = ""
+        sent = 0
+
+        # run_async uses the async genai client and google_search runs as
+        # server-side grounding, so nothing here blocks the event loop and the
+        # loop is not offloaded to a thread.
+        final_event = None
+        async with aclosing(runner.run_async(
             user_id=user_id,
             session_id=session_id,
-            new_message=user_message
-        )
-
-        if result and result.parts:
-            return result.parts[0].text or "I could not generate a response."
-
-        return "I received your message but couldn't generate a response."
+            new_message=user_message,
+            run_config=run_config
+        )) as events:
+            async for event in events:
+                if event.is_final_response():
+                    final_event = event
+                    break
+
+                if event.partial:
+                    turn_text += event_text(event)
+                    while chunk := take_chunk(turn_text[sent:]):
+                        sent += len(chunk)
+                        yield chunk
+                else:
+                    # The turn ended in a tool call; the final answer comes in
+                    # a new turn.
+                    turn_text = ""
+                    sent = 0
+
+        reply = event_text(final_event) if final_event else ""
+        if reply:
+            if cache_key is not None:
+                await set_cached_reply(cache_key, reply)
+            if reply.startswith(turn_text[:sent]):
+                reply = reply[sent:]
+            for chunk in iter_chunks(reply):
+                yield chunk
+            return
+
+        if final_event and final_event.content and final_event.content.parts:
+            yield "I could not generate a response."
+            return
+
+        yield "I received your message but couldn't generate a response."
 
     except Exception as e:
-        logger.error(f"AI error: {str(e)}")
-        return "Sorry, I encountered an error."
+        logger.error("AI error: %s", e)
+        yield "Sorry, I encountered an error."
 
 
-def send_whatsapp_message(to: str, message: str):
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
-        "Content-Type": "application/json"
-    }
-
+async def send_whatsapp_message(to: str, message: str) -> None:
     payload = {
         "messaging_product": "whatsapp",
         "to": to,
@@ -88,14 +339,204 @@ def send_whatsapp_message(to: str, message: str):
     }
 
     try:
-        r = requests.post(WHATSAPP_API_URL, json=payload, headers=headers)
-        logger.info(f"WhatsApp send response: {r.text}")
+        r = await http_client.post(WHATSAPP_API_URL, content=orjson.dumps(payload), headers=WHATSAPP_HEADERS)
+        r.raise_for_status()
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("WhatsApp send response: %s", r.text)
     except Exception as e:
-        logger.error(f"Error sending WhatsApp message: {str(e)}")
+        logger.error("Error sending WhatsApp message: %s", e)
+
+
+async def send_after(previous: asyncio.Task[None] | None, to: str, message: str) -> None:
+    if previous is not None:
+        await previous
+    await send_whatsapp_message(to, message)
+
+
+async def handle_message(from_number: str, text: str) -> None:
+    # Each chunk is sent while the model keeps generating, but only after the
+    # previous chunk has gone out so the user sees them in order.
+    previous = None
+    async for chunk in run_agent(text, from_number):
+        chunk = chunk.strip()
+        if chunk:
+            previous = asyncio.create_task(send_after(previous, from_number, chunk))
+
+    if previous is not None:
+        await previous
+
+
+async def is_rate_limited(from_number: str) -> bool:
+    if redis_client is not None:
+        key = f"rl:{from_number}"
+        # One MULTI: the key is created with its expiry before it is ever
+        # incremented, so a failure part-way can't leave a counter that never
+        # expires.
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.set(key, 0, ex=RATE_LIMIT_WINDOW, nx=True)
+            pipe.incr(key)
+            _, count = await pipe.execute()
+        return count > RATE_LIMIT
+
+    key = (from_number, int(time.monotonic() // RATE_LIMIT_WINDOW))
+    count = rate_counts.get(key, 0) + 1
+    rate_counts[key] = count
+    return count > RATE_LIMIT
+
+
+async def enqueue_message(from_number: str, text: str) -> None:
+    if await is_rate_limited(from_number):
+        logger.warning("Rate limit exceeded, dropping message from %s", from_number)
+        return
+
+    if redis_client is not None:
+        await redis_client.xadd(
+            STREAM_KEY,
+            {"from": from_number, "text": text},
+            maxlen=STREAM_MAXLEN,
+            approximate=True
+        )
+        return
+
+    try:
+        queue_for(from_number).put_nowait((from_number, text, None))
+    except asyncio.QueueFull:
+        logger.warning("Queue full, dropping message from %s", from_number)
+
+
+def queue_for(from_number: str) -> asyncio.Queue[WorkItem]:
+    return worker_queues[hash(from_number) % len(worker_queues)]
+
+
+async def worker(queue: asyncio.Queue[WorkItem]) -> None:
+    while True:
+        from_number, text, entry_id = await queue.get()
+        try:
+            await handle_message(from_number, text)
+        except Exception as e:
+            logger.error("Worker error: %s", e)
+        finally:
+            queue.task_done()
+
+        if entry_id is not None:
+            try:
+                await redis_client.xack(STREAM_KEY, STREAM_GROUP, entry_id)
+            except Exception as e:
+                logger.error("Stream ack error: %s", e)
+            finally:
+                in_flight.discard(entry_id)
+
+
+async def stream_reader(consumer: str) -> None:
+    # XAUTOCLAIM scans the pending list in pages; keep the cursor so entries
+    # further down are reached even while the first page is still in flight.
+    claim_cursor = "0-0"
+    while True:
+        try:
+            # Pick up messages left pending by a consumer that died mid-way,
+            # then fall back to new deliveries.
+            claimed = await redis_client.xautoclaim(
+                STREAM_KEY,
+                STREAM_GROUP,
+                consumer,
+                min_idle_time=STREAM_CLAIM_IDLE_MS,
+                start_id=claim_cursor,
+                count=NUM_WORKERS
+            )
+            claim_cursor = claimed[0]
+            entries = [entry for entry in claimed[1] if entry[0] not in in_flight]
+            if not entries:
+                response = await redis_client.xreadgroup(
+                    STREAM_GROUP,
+                    consumer,
+                    {STREAM_KEY: ">"},
+                    count=NUM_WORKERS,
+                    block=5000
+                )
+                entries = [entry for _, stream_entries in response for entry in stream_entries]
+
+            for entry_id, fields in entries:
+                if not fields:
+                    await redis_client.xack(STREAM_KEY, STREAM_GROUP, entry_id)
+                    continue
+                in_flight.add(entry_id)
+                await queue_for(fields["from"]).put((fields["from"], fields["text"], entry_id))
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Stream reader error: %s", e)
+            await asyncio.sleep(1)
+
+
+async def stream_heartbeat(consumer: str) -> None:
+    # Entries wait in the local queues until a worker acks them, which can
+    # take longer than STREAM_CLAIM_IDLE_MS under a backlog. Re-claiming them
+    # resets their idle time so another consumer won't answer them again.
+    while True:
+        await asyncio.sleep(STREAM_HEARTBEAT_SECONDS)
+        if not in_flight:
+            continue
+        try:
+            await redis_client.xclaim(
+                STREAM_KEY,
+                STREAM_GROUP,
+                consumer,
+                min_idle_time=0,
+                message_ids=list(in_flight),
+                justid=True
+            )
+        except Exception as e:
+            logger.error("Stream heartbeat error: %s", e)
+
+
+@app.on_event("startup")
+async def start_workers() -> None:
+    for _ in range(NUM_WORKERS):
+        queue: asyncio.Queue[WorkItem] = asyncio.Queue(maxsize=QUEUE_MAXSIZE // NUM_WORKERS)
+        worker_queues.append(queue)
+        worker_tasks.append(asyncio.create_task(worker(queue)))
+
+    if redis_client is not None:
+        try:
+            await redis_client.xgroup_create(STREAM_KEY, STREAM_GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+        consumer = f"{socket.gethostname()}-{os.getpid()}"
+        worker_tasks.append(asyncio.create_task(stream_reader(consumer)))
+        worker_tasks.append(asyncio.create_task(stream_heartbeat(consumer)))
+
+
+@app.on_event("shutdown")
+async def stop_workers() -> None:
+    for task in worker_tasks:
+        task.cancel()
+    await asyncio.gather(*worker_tasks, return_exceptions=True)
+    worker_tasks.clear()
+
+
+@app.on_event("shutdown")
+async def close_http_client() -> None:
+    await http_client.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
+
+
+def iter_text_messages(data: dict) -> Iterator[tuple[str, str]]:
+    for entry in data.get("entry", ()):
+        for change in entry.get("changes", ()):
+            match change:
+                case {"value": {"messages": list(messages)}}:
+                    for msg in messages:
+                        match msg:
+                            case {"from": str(from_number), "text": {"body": str(text)}}:
+                                yield from_number, text
 
 
 @app.get("/webhook")
-async def verify_webhook(request: Request):
+async def verify_webhook(request: Request) -> PlainTextResponse:
     mode = request.query_params.get("hub.mode")
     token = request.query_params.get("hub.verify_token")
     challenge = request.query_params.get("hub.challenge")
@@ -106,30 +547,57 @@ async def verify_webhook(request: Request):
     raise HTTPException(status_code=403)
 
 
-@app.post("/webhook")
-async def receive_message(request: Request):
+# response_model=None keeps FastAPI from validating the return annotation.
+@app.post("/webhook", response_model=None)
+async def receive_message(request: Request) -> dict[str, str]:
     try:
-        data = await request.json()
-        logger.info(f"Webhook received: {data}")
+        raw = await request.body()
+
+        # Most deliveries are status updates or chatter without the trigger
+        # word; skip them before paying for a full JSON parse.
+        if b'"messages"' not in raw:
+            return {"status": "ok"}
+        if not TRIGGER_PATTERN_BYTES.search(raw):
+            return {"status": "ok"}
+
+        data = orjson.loads(raw)
+        logger.info("Webhook received: %d bytes, object=%s", len(raw), data.get("object"))
 
         if data.get("object") != "whatsapp_business_account":
             return {"status": "ignored"}
 
-        for entry in data.get("entry", []):
-            for change in entry.get("changes", []):
-                value = change.get("value", {})
-                messages = value.get("messages", [])
-
-                for msg in messages:
-                    from_number = msg.get("from")
-                    text = msg.get("text", {}).get("body")
+        pending: list[tuple[str, str]] = [
+            (from_number, text)
+            for from_number, text in iter_text_messages(data)
+            if from_number and text and TRIGGER_PATTERN.search(text)
+        ]
 
-                    if from_number and text:
-                        ai_reply = await run_agent(text, from_number)
-                        send_whatsapp_message(from_number, ai_reply)
+        # Enqueued one after another so each sender's messages keep their
+        # payload order in the stream.
+        for from_number, text in pending:
+            try:
+                await enqueue_message(from_number, text)
+            except Exception as e:
+                logger.error("Enqueue error: %s", e)
 
         return {"status": "ok"}
 
     except Exception as e:
-        logger.error(f"Webhook error: {str(e)}")
-        return {"status": "error", "message": str(e)}
\ No newline at end of file
+        logger.error("Webhook error: %s", e)
+        return {"status": "error", "message": str(e)}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # uvicorn needs an import string to spawn several workers, but importing
+    # "main" from here would run all module setup a second time, so a single
+    # worker is given the app object instead.
+    uvicorn.run(
+        "main:app" if WEB_CONCURRENCY > 1 else app,
+        host="0.0.0.0",
+        port=8080,
+        workers=WEB_CONCURRENCY,
+        loop="uvloop",
+        http="httptools"
+    )